@@ -5,40 +5,95 @@ configurable patterns.
 """
 
 import argparse
-from dataclasses import dataclass
-from datetime import datetime
+from dataclasses import dataclass, field
+import functools
 import json
 import logging
 import os
 import re
-from typing import List
+import time
+from typing import Any, Dict, List
 
 import praw
 import prawcore.exceptions
-import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import re2
+except ImportError:
+    re2 = None
 
 
 __version__ = '1.2.1'
 
+_SUPPORTED_SORTS = frozenset({
+    'best', 'blank', 'confidence', 'controversial', 'live', 'new', 'old', 'q&a', 'qa', 'random', 'top',
+})
 
-def _hours_since(start):
-    return float((datetime.utcnow() - start).total_seconds()) / 60 / 60
+_METACHARS = re.compile(r'[.^$*+?{}\[\]\\|()]')
 
+_BACKREF = re.compile(r'\\[1-9]|\(\?P=')
 
-def get_stickies(subreddit):
-    stickies = []
-    try:
-        stickies.append(subreddit.sticky(number=1))
-    except prawcore.exceptions.NotFound:
-        pass
+
+def _hours_since(timestamp):
+    return (time.time() - timestamp) / 3600
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(pattern):
+    # Prefer RE2 for its linear-time matching guarantee; fall back to the
+    # stdlib engine if RE2 isn't installed or doesn't support the pattern.
+    if re2 is not None:
+        options = re2.Options()
+        options.case_sensitive = False
+        options.log_errors = False  # Rejected patterns are logged below instead.
+        try:
+            return re2.compile(pattern, options)
+        except re2.error:
+            logging.debug("Pattern '%s' not supported by RE2, using re.", pattern)
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def _combine_patterns(rules):
+    """Compile one pattern matching any title matched by at least one rule."""
+    patterns = [rule.pattern for rule in rules]
+    if any(_BACKREF.search(p) for p in patterns):
+        return None  # Group numbers shift once the patterns are joined.
     try:
-        stickies.append(subreddit.sticky(number=2))
-    except prawcore.exceptions.NotFound:
-        pass
-    return stickies
+        return _compile('|'.join(f'(?:{p})' for p in patterns))
+    except re.error:
+        return None
+
+
+def _combined_score(submission):
+    return submission.score + submission.num_comments
+
+
+def _flair_template_ids(submission):
+    return {choice['flair_template_id'] for choice in submission.flair.choices()}
+
+
+def get_stickies(subreddit):
+    # Stickies lead the hot listing, so one listing request returns both slots.
+    return [s for s in subreddit.hot(limit=2) if s.stickied]
+
 
+def get_new_submissions(subreddit, max_age_hrs, limit=100):
+    """Get new submissions no older than max_age_hrs, newest first."""
+    submissions = []
+    # The listing is newest first, so stop paging at the first submission that's too old.
+    for submission in subreddit.new(limit=limit):
+        if _hours_since(submission.created_utc) > max_age_hrs:
+            break
+        submissions.append(submission)
+    return submissions
 
-@dataclass
+
+@dataclass(frozen=True)
 class Rule(object):
     """Rule for lifecycling existing stickies and stickying new submissions."""
 
@@ -53,22 +108,40 @@ class Rule(object):
     sort_update_age_hrs: float = 4
     flair_text: str = None
     flair_template_id: str = None
+    _regex: Any = field(init=False, repr=False, compare=False, default=None)
+    _literal: str = field(init=False, repr=False, compare=False, default=None)
+
+    def __post_init__(self):
+        unsupported = set(self.sort_list or ()) - _SUPPORTED_SORTS
+        if unsupported:
+            raise ValueError(f"Unsupported sorts {sorted(unsupported)} in rule '{self.label}'.")
+        if _METACHARS.search(self.pattern):
+            object.__setattr__(self, '_regex', _compile(self.pattern))
+        else:
+            # Plain text patterns are matched with a substring test.
+            object.__setattr__(self, '_literal', self.pattern.lower())
 
     def check(self, submission: praw.models.Submission):
         """Check if a submission should be handled by this Rule."""
-        pat = re.compile(self.pattern.lower())
-        return bool(pat.search(submission.title.lower()))
+        if self._literal is not None:
+            return self._literal in submission.title.lower()
+        return bool(self._regex.search(submission.title))
+
+    def apply(self, submission: praw.models.Submission, karma: Dict[str, int] = None):
+        """Determine if a submission is eligible to be stickied for this Rule.
 
-    def apply(self, submission: praw.models.Submission):
-        """Determine if a submission is eligible to be stickied for this Rule."""
+        Author comment karma is read from the optional prefetched karma mapping
+        when given, avoiding a lazy author fetch per submission.
+        """
         if not self.check(submission):
             return False
 
-        created = datetime.utcfromtimestamp(submission.created_utc)
-        if _hours_since(created) > self.max_age_hrs:
+        if _hours_since(submission.created_utc) > self.max_age_hrs:
             return False
 
-        user_karma = submission.author.comment_karma
+        user_karma = karma.get(submission.author.name) if karma is not None else None
+        if user_karma is None:
+            user_karma = submission.author.comment_karma
         if user_karma < self.min_karma:
             submission.mod.remove()
             try:
@@ -76,18 +149,17 @@ class Rule(object):
                 comment = submission.reply("Your submission is pending moderator approval due to your comment karma being below the threshold for this type of submission. Message the moderators if you have any questions.")
                 comment.mod.distinguish()
             except prawcore.exceptions.InsufficientScope:
-                logging.warn("Lacking scope to notify moderators of removed eligible sticky.")
+                logging.warning("Lacking scope to notify moderators of removed eligible sticky.")
             return False
 
         return True
 
     def lifecycle(self, sticky: praw.models.Submission):
         """Update an existing sticky according to this Rule."""
-        created = datetime.utcfromtimestamp(sticky.created_utc)
-        hours_since_created = _hours_since(created)
+        hours_since_created = _hours_since(sticky.created_utc)
 
         if hours_since_created > self.remove_age_hrs:
-            logging.info(f"Unstickying stale sticky '{sticky.fullname}'.")
+            logging.info("Unstickying stale sticky '%s'.", sticky.fullname)
             sticky.mod.sticky(False)
             return True
 
@@ -97,27 +169,54 @@ class Rule(object):
             new_sort = self.sort_list[sort_idx]
 
             if new_sort != current_sort:
-                logging.info(f"Setting suggested sort from '{current_sort}' to '{new_sort}' for sticky '{sticky.fullname}'.")
+                logging.info("Setting suggested sort from '%s' to '%s' for sticky '%s'.", current_sort, new_sort, sticky.fullname)
                 sticky.mod.suggested_sort(new_sort)
 
         if not sticky.link_flair_text:
-            flair_template_ids = (d['flair_template_id'] for d in sticky.flair.choices())
-            if self.flair_template_id and self.flair_template_id in flair_template_ids:
-                logging.info(f"Setting flair to ID '{self.flair_template_id}' for sticky '{sticky.fullname}'.")
+            if self.flair_template_id and self.flair_template_id in _flair_template_ids(sticky):
+                logging.info("Setting flair to ID '%s' for sticky '%s'.", self.flair_template_id, sticky.fullname)
                 sticky.flair.select(self.flair_template_id, text=self.flair_text)
             elif self.flair_text:
-                logging.info(f"Setting flair text to '{self.flair_text}' for sticky '{sticky.fullname}'.")
+                logging.info("Setting flair text to '%s' for sticky '%s'.", self.flair_text, sticky.fullname)
                 sticky.mod.flair(self.flair_text)
 
         return False
 
 
-def _get_comment(reddit, submission):
-    comments = reddit.user.me().comments.new(limit=100)
-    relevant = list(filter(lambda c: c.submission.fullname == submission.fullname, comments))
-    if relevant:
-        return relevant[0]
-    return None
+def _comment_karma(redditor):
+    try:
+        return redditor.comment_karma
+    except (AttributeError, prawcore.exceptions.NotFound):
+        return 0  # Suspended or deleted account.
+    except prawcore.exceptions.PrawcoreException:
+        logging.warning("Failed to prefetch comment karma for '%s'.", redditor.name)
+        return None
+
+
+def _fetch_karma(submissions):
+    """Fetch the comment karma of each distinct submission author once."""
+    karma = {}
+    for submission in submissions:
+        author = submission.author
+        if author and author.name not in karma:
+            karma[author.name] = _comment_karma(author)
+    return {name: k for name, k in karma.items() if k is not None}
+
+
+def _best_eligible(rule, submissions, karma):
+    """Get the highest scoring submission eligible for a rule, with its score."""
+    best, best_score = None, None
+    for submission in submissions:
+        if not rule.apply(submission, karma):
+            continue
+        score = _combined_score(submission)
+        if best is None or score > best_score:
+            best, best_score = submission, score
+    return best, best_score
+
+
+def _get_comment(comments, submission):
+    return next((c for c in comments if c.submission.fullname == submission.fullname), None)
 
 
 def _parse_args():
@@ -131,53 +230,106 @@ def main():
 
     args = _parse_args()
 
-    with open(args.config) as conf_fo:
-        conf = json.load(conf_fo)
+    with open(args.config, 'rb') as conf_fo:
+        conf = (orjson or json).loads(conf_fo.read())
 
-    reddit = praw.Reddit('stickybot')
+    reddit = praw.Reddit('stickybot', check_for_updates=False)
     subreddit = reddit.subreddit(conf['subreddit'])
-    logging.info(f"Running StickyBot against /r/{subreddit.display_name}.")
+    logging.info("Running StickyBot against /r/%s.", subreddit.display_name)
+
+    rules = [Rule(**r) for r in conf['rules']]
+    max_age_hrs = max((r.max_age_hrs for r in rules), default=0)
+    my_comments = None  # Fetched at most once, on first use.
 
     stickies = get_stickies(subreddit)
-    submissions = tuple(subreddit.new(limit=100))
+    submissions = get_new_submissions(subreddit, max_age_hrs)
 
-    rules = [Rule(**r) for r in conf['rules']]
+    submissions = tuple(s for s in submissions if not s.stickied)
+
+    # Scan each title once to drop submissions that no rule could match.
+    matcher = _combine_patterns(rules)
+    if matcher is not None:
+        submissions = tuple(s for s in submissions if matcher.search(s.title))
+    else:
+        submissions = tuple(s for s in submissions if any(r.check(s) for r in rules))
+
+    # Lifecycle current stickies for every rule before stickying anything, so
+    # slots freed by any rule are known up front.
+    slots = [s.fullname for s in stickies]  # Live stickies, top to bottom.
+    has_sticky = []
     for rule in rules:
-        logging.info(f"Executing rule '{rule.label}'...")
+        live = []
+        for sticky in stickies:
+            if sticky.fullname in slots and rule.check(sticky):
+                if rule.lifecycle(sticky):
+                    slots.remove(sticky.fullname)
+                else:
+                    live.append(sticky)
+        has_sticky.append(bool(live))
+
+    # Stickies matching any rule, plus those placed this run, are held by rules.
+    # Other live stickies were placed manually by moderators.
+    held = {s.fullname for s in stickies if s.fullname in slots and any(r.check(s) for r in rules)}
+
+    # Prefetch karma only for authors of submissions a rule could still select.
+    if len(slots) >= 2 and slots[-1] in held:
+        selecting = []
+    else:
+        selecting = [r for r, rule_has_sticky in zip(rules, has_sticky) if not rule_has_sticky]
+    karma = _fetch_karma(
+        s for s in submissions
+        if any(r.check(s) and _hours_since(s.created_utc) <= r.max_age_hrs for r in selecting)
+    )
+
+    for rule, rule_has_sticky in zip(rules, has_sticky):
+        logging.info("Executing rule '%s'...", rule.label)
+
+        if rule_has_sticky:
+            logging.info("Sticky already exists for rule '%s'.", rule.label)
+            continue
 
-        # Check current stickies for existing sticky matching rule.
-        existing = list(filter(rule.check, stickies))
-        if not all(map(rule.lifecycle, existing)):
-            logging.info(f"Sticky already exists for rule '{rule.label}'.")
+        # Reddit allows two stickies; stickying into full slots replaces the bottom one.
+        if len(slots) >= 2 and slots[-1] in held:
+            logging.info("Bottom sticky slot is held by a rule; skipping rule '%s'.", rule.label)
             continue
 
-        # Identify eligible submissions according to this rule.
-        eligible = list(filter(rule.apply, submissions))
-        if not eligible:
-            logging.info(f"No eligible submissions found for rule.")
+        # Select the "best" submission from the submissions eligible for this rule,
+        # skipping any an earlier rule stickied this run.
+        candidates = (s for s in submissions if s.fullname not in held)
+        best, best_score = _best_eligible(rule, candidates, karma)
+        if best is None:
+            logging.info("No eligible submissions found for rule.")
             continue
 
-        # Select the "best" submission from the eligible submissions.
-        best = max(eligible, key=lambda s: s.score + s.num_comments)
-        if best.score + best.num_comments < rule.min_score:
-            logging.info(f"Best submission {best.fullname} for rule didn't meet combined score requirements, with score {best.score + best.num_comments}.")
+        if best_score < rule.min_score:
+            logging.info("Best submission %s for rule didn't meet combined score requirements, with score %s.", best.fullname, best_score)
             continue  # Don't sticky, let it marinate.
 
         best.mod.sticky()
-        best.mod.suggested_sort(rule.sort_list[0])
-        if rule.flair_template_id and rule.flair_template_id in best.flair.choices():
-            logging.info(f"Setting flair to ID '{rule.flair_template_id}' for submission '{best.fullname}'.")
+        if len(slots) >= 2:
+            slots[-1] = best.fullname
+        else:
+            slots.append(best.fullname)
+        held.add(best.fullname)
+        if rule.sort_list:
+            best.mod.suggested_sort(rule.sort_list[0])
+        if rule.flair_template_id and rule.flair_template_id in _flair_template_ids(best):
+            logging.info("Setting flair to ID '%s' for submission '%s'.", rule.flair_template_id, best.fullname)
             best.flair.select(rule.flair_template_id, text=rule.flair_text)
         elif rule.flair_text:
-            logging.info(f"Setting flair text to '{rule.flair_text}' for submission '{best.fullname}'.")
+            logging.info("Setting flair text to '%s' for submission '%s'.", rule.flair_text, best.fullname)
             best.mod.flair(rule.flair_text)
 
         # Post comment to the submission if specified.
-        if rule.comment and not _get_comment(reddit, best):
-            reply = best.reply(rule.comment)
-            reply.mod.distinguish()
-
-        logging.info(f"Stickied submission {best.fullname}.")
+        if rule.comment:
+            if my_comments is None:
+                my_comments = list(reddit.user.me().comments.new(limit=100))
+            if not _get_comment(my_comments, best):
+                reply = best.reply(rule.comment)
+                reply.mod.distinguish()
+                my_comments.insert(0, reply)
+
+        logging.info("Stickied submission %s.", best.fullname)
 
 
 if __name__ == '__main__':